@@ -1,24 +1,52 @@
-import matplotlib
-
-matplotlib.use("qt5agg")
-
+import numpy as np
 import rasterio
 import rasterio.plot
-import matplotlib.pyplot as plt
-from collections import OrderedDict
-import geojson
-import json
+import rasterio.windows
+import orjson
+import array
 import sys
 import re
 import os
 
+from myutil import GDAL_ENV, display_shape, rasterio_as_image
+
+_TIF_RE = re.compile(r"\.tiff?$", re.IGNORECASE)
+
+EXISTING_COLORS = ["pink", "red", "green", "orange", "cyan", "magenta", "yellow"]
+
+
+def multilinestring_feature(segments):
+    # Plain dicts; the geojson classes validate every coordinate on construction
+    return {
+        "type": "Feature",
+        "geometry": {"type": "MultiLineString", "coordinates": segments},
+        "properties": {},
+    }
+
+
+def select_backend():
+    # MPLBACKEND (e.g. MPLBACKEND=macosx, the fastest choice on Apple Silicon)
+    # is honoured by matplotlib itself. Otherwise prefer Qt; switch_backend
+    # actually loads it, so a missing binding or display raises here and
+    # matplotlib's automatic selection (Tk, then Agg, ...) is kept instead.
+    if "MPLBACKEND" in os.environ:
+        return
+    import matplotlib.pyplot as plt
+
+    try:
+        plt.switch_backend("QtAgg")
+    except ImportError:
+        pass
+
 
 class PointAnnotator:
     def __init__(self, ax, meters_per_pixel=None):
+        from matplotlib.lines import Line2D
+
         self.ax = ax
         self.segments = []
-        self.current_segment = []
-        self.markers = []
+        # Flat x, y pairs as C ints rather than a list of two-element lists
+        self.current_segment = array.array("i")
         self.fig = ax.figure
 
         self.colors = [
@@ -33,12 +61,44 @@ class PointAnnotator:
         ]
         self.current_color_index = 0
 
+        # One marker-only line per color holds all its points, so a click adds
+        # no artists. They are animated so clicks can blit them over a cached
+        # copy of the map.
+        self._xs = [[] for _ in self.colors]
+        self._ys = [[] for _ in self.colors]
+        self._lines = []
+        for color in self.colors:
+            line = Line2D(
+                [],
+                [],
+                linestyle="",
+                marker="+",
+                markersize=8,
+                markeredgewidth=1,
+                color=color,
+                animated=True,
+            )
+            ax.add_line(line)
+            self._lines.append(line)
+        self._bg = None
+
         # Store initial view for zoom calculation
         self.initial_xlim = None
         self.initial_ylim = None
         self.zoom_level = 1.0
         self.meters_per_pixel = meters_per_pixel
 
+        # Only the zoom level changes, so build the rest of the title once
+        title_parts = []
+        if meters_per_pixel is not None:
+            title_parts.append(f"{meters_per_pixel:.2f}m/px")
+        title_parts.append("Zoom: %sx")
+        title_parts.append(
+            "Click: add | z: undo | +/-: zoom | wasd: pan | space: complete segment | h: reset | Enter: finish"
+        )
+        self._title_template = " | ".join(title_parts)
+        self._last_zoom_str = None
+
         # Disable default matplotlib key bindings
         self.fig.canvas.mpl_disconnect(self.fig.canvas.manager.key_press_handler_id)
 
@@ -46,6 +106,12 @@ class PointAnnotator:
             "button_press_event", self.on_click
         )
         self.cid_key = self.fig.canvas.mpl_connect("key_press_event", self.on_key)
+        self.cid_draw = self.fig.canvas.mpl_connect("draw_event", self.on_draw)
+
+    def on_draw(self, event):
+        # Full redraws (zoom, pan, resize) invalidate the cached background
+        self._bg = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+        self.draw_markers()
 
     def on_click(self, event):
         if event.inaxes != self.ax:
@@ -60,6 +126,8 @@ class PointAnnotator:
         if event.key in ["z", "Z"]:  # Undo with 'z'
             self.remove_last_point()
         elif event.key in ["enter", "return"]:  # Finish with Enter
+            import matplotlib.pyplot as plt
+
             self.complete_segment()
             plt.close(self.fig)
         elif event.key == " ":
@@ -82,7 +150,7 @@ class PointAnnotator:
             self.initial_ylim = self.ax.get_ylim()
             self.zoom_level = 1.0
             self.update_title()
-            self.fig.canvas.draw()
+            self.fig.canvas.draw_idle()
 
     def zoom(self, factor):
         xlim = self.ax.get_xlim()
@@ -94,7 +162,7 @@ class PointAnnotator:
         self.ax.set_xlim(xmid - xrange / 2, xmid + xrange / 2)
         self.ax.set_ylim(ymid - yrange / 2, ymid + yrange / 2)
         self.update_zoom_level()
-        self.fig.canvas.draw()
+        self.fig.canvas.draw_idle()
 
     def pan(self, dx_frac, dy_frac):
         xlim = self.ax.get_xlim()
@@ -103,7 +171,7 @@ class PointAnnotator:
         yrange = ylim[1] - ylim[0]
         self.ax.set_xlim(xlim[0] + dx_frac * xrange, xlim[1] + dx_frac * xrange)
         self.ax.set_ylim(ylim[0] + dy_frac * yrange, ylim[1] + dy_frac * yrange)
-        self.fig.canvas.draw()
+        self.fig.canvas.draw_idle()
 
     def update_zoom_level(self):
         if self.initial_xlim is None or self.initial_ylim is None:
@@ -121,108 +189,156 @@ class PointAnnotator:
         self.update_title()
 
     def update_title(self):
-        title_parts = []
-        if self.meters_per_pixel is not None:
-            title_parts.append(f"{self.meters_per_pixel:.2f}m/px")
-        title_parts.append(f"Zoom: {self.zoom_level:.1f}x")
-        title_parts.append(
-            "Click: add | z: undo | +/-: zoom | wasd: pan | space: complete segment | h: reset | Enter: finish"
-        )
-        self.ax.set_title(" | ".join(title_parts))
+        # Setting the title re-lays out text, so skip it if nothing visible changed
+        zoom_str = f"{self.zoom_level:.1f}"
+        if zoom_str == self._last_zoom_str:
+            return
+        self._last_zoom_str = zoom_str
+        self.ax.set_title(self._title_template % zoom_str)
 
     def add_point(self, x, y):
         x = round(x)
         y = round(y)
-        self.current_segment.append([x, y])
-        (marker,) = self.ax.plot(
-            x,
-            y,
-            "+",
-            markersize=8,
-            markeredgewidth=1,
-            color=self.colors[self.current_color_index],
-        )
-        self.markers.append(marker)
-        self.fig.canvas.draw()
+        self.current_segment.extend((x, y))
+        self._xs[self.current_color_index].append(x)
+        self._ys[self.current_color_index].append(y)
+        self.update_markers()
 
     def complete_segment(self):
         if self.current_segment:
-            self.segments.append(self.current_segment)
-            self.current_segment = []
+            points = np.frombuffer(self.current_segment, dtype=np.intc)
+            self.segments.append(points.reshape(-1, 2).tolist())
+            self.current_segment = array.array("i")
             # Cycle to next color
             self.current_color_index = (self.current_color_index + 1) % len(self.colors)
 
     def remove_last_point(self):
         if self.current_segment:
-            self.current_segment.pop()
-            marker = self.markers.pop()
-            marker.remove()
-            self.fig.canvas.draw()
+            del self.current_segment[-2:]
+            self._xs[self.current_color_index].pop()
+            self._ys[self.current_color_index].pop()
+            self.update_markers()
+
+    def update_markers(self):
+        ci = self.current_color_index
+        self._lines[ci].set_data(self._xs[ci], self._ys[ci])
+        if self._bg is None:
+            self.fig.canvas.draw_idle()
+            return
+        self.fig.canvas.restore_region(self._bg)
+        self.draw_markers()
+        self.fig.canvas.blit(self.ax.bbox)
+
+    def draw_markers(self):
+        for line in self._lines:
+            if len(line.get_xdata()):
+                self.ax.draw_artist(line)
 
     def annotate(self):
+        import matplotlib.pyplot as plt
+
         # Initialize zoom tracking
         self.initial_xlim = self.ax.get_xlim()
         self.initial_ylim = self.ax.get_ylim()
         self.update_title()
         plt.show()
-        return geojson.Feature(None, geojson.MultiLineString(self.segments))
+        return multilinestring_feature(self.segments)
 
 
 def annotate_image(image_path, geojson_path=None):
+    # matplotlib is imported here rather than at module level, so importing this
+    # module (e.g. for batch use with MPLBACKEND=Agg) doesn't pay for GUI setup
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
+
     # Load existing GeoJSON if it exists
     existing_segments = []
     if geojson_path and os.path.exists(geojson_path):
         try:
-            with open(geojson_path, "r") as f:
-                existing_feature = geojson.load(f)
+            with open(geojson_path, "rb") as f:
+                existing_feature = orjson.loads(f.read())
                 if existing_feature.get("geometry", {}).get("type") == "MultiLineString":
                     existing_segments = existing_feature["geometry"]["coordinates"]
                     print(f"Loaded {len(existing_segments)} existing segments from {geojson_path}")
         except Exception as e:
             print(f"Warning: Could not load existing GeoJSON: {e}")
 
-    with rasterio.open(image_path) as src:
-        # From rasterio.plot.show
-        source_colorinterp = OrderedDict(zip(src.colorinterp, src.indexes))
-        colorinterp = rasterio.enums.ColorInterp
-        # Gather the indexes of the RGB channels in that order
-        rgb_indexes = [
-            source_colorinterp[ci]
-            for ci in (colorinterp.red, colorinterp.green, colorinterp.blue)
-        ]
-        im = rasterio.plot.reshape_as_image(src.read(rgb_indexes, masked=True))
-
-        _fig, ax = plt.subplots(figsize=(11, 9))
-        ax.imshow(im, extent=rasterio.plot.plotting_extent(src))
-
-        # Plot existing segments
-        colors = ["pink", "red", "green", "orange", "cyan", "magenta", "yellow"]
-        for idx, segment in enumerate(existing_segments):
-            xs = [point[0] for point in segment]
-            ys = [point[1] for point in segment]
-            ax.plot(
-                xs,
-                ys,
-                "o-",
-                color=colors[idx % len(colors)],
-                markersize=3,
-                markeredgewidth=1,
-                alpha=0.8,
-            )
-
-        # Get meters per pixel from the transform
+    # Only the header is needed here; pixels come from the shared cached reader
+    with rasterio.Env(**GDAL_ENV), rasterio.open(image_path) as src:
+        shape = (src.height, src.width)
+        transform = src.transform
+        extent = rasterio.plot.plotting_extent(src)
         # src.transform[0] is the pixel width in the CRS units
         meters_per_pixel = abs(src.transform[0])
 
-        annotator = PointAnnotator(ax, meters_per_pixel=meters_per_pixel)
-        # Set the color index to continue from where we left off
-        annotator.current_color_index = len(existing_segments) % len(colors)
+    fig, ax = plt.subplots(figsize=(11, 9))
+    # Read at screen resolution rather than decoding the full raster
+    im = rasterio_as_image(image_path, out_shape=display_shape(shape, fig))
+    image = ax.imshow(im, extent=extent)
+
+    def show_visible(_ax):
+        # Re-read just the visible part of the map at screen resolution, so
+        # zooming in reveals native detail instead of upscaling the first read
+        (x0, x1), (y0, y1) = ax.get_xlim(), ax.get_ylim()
+        window = rasterio.windows.from_bounds(
+            min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1), transform
+        )
+        row0 = max(0, int(np.floor(window.row_off)))
+        col0 = max(0, int(np.floor(window.col_off)))
+        row1 = min(shape[0], int(np.ceil(window.row_off + window.height)))
+        col1 = min(shape[1], int(np.ceil(window.col_off + window.width)))
+        if row1 <= row0 or col1 <= col0:
+            return  # Panned entirely off the map
+        window = rasterio.windows.Window(col0, row0, col1 - col0, row1 - row0)
+        image.set_data(
+            rasterio_as_image(
+                image_path,
+                out_shape=display_shape((window.height, window.width), fig),
+                window=window,
+            )
+        )
+        left, bottom, right, top = rasterio.windows.bounds(window, transform)
+        # set_extent would otherwise autoscale the view to the new window
+        autoscale = ax.get_autoscale_on()
+        ax.set_autoscale_on(False)
+        image.set_extent((left, right, bottom, top))
+        ax.set_autoscale_on(autoscale)
+        # Keep 'h' resetting to the whole map without margins
+        image.sticky_edges.x[:] = extent[:2]
+        image.sticky_edges.y[:] = extent[2:]
+
+    ax.callbacks.connect("xlim_changed", show_visible)
+    ax.callbacks.connect("ylim_changed", show_visible)
+
+    # Plot existing segments as one line collection plus one marker collection
+    segs, cols = [], []
+    for idx, segment in enumerate(existing_segments):
+        arr = np.asarray(segment, dtype=np.float32)
+        if arr.size == 0:
+            continue
+        # Positions may carry an altitude; only x and y are drawn
+        segs.append(arr[:, :2])
+        cols.append(EXISTING_COLORS[idx % len(EXISTING_COLORS)])
+    if segs:
+        ax.add_collection(LineCollection(segs, colors=cols, linewidths=1, alpha=0.8))
+        # Cap markers per segment so very long segments stay cheap to draw
+        marked = [seg[:: max(1, len(seg) // 500)] for seg in segs]
+        points = np.concatenate(marked)
+        point_cols = np.repeat(cols, [len(m) for m in marked])
+        ax.scatter(
+            points[:, 0], points[:, 1], s=9, c=point_cols, linewidths=1, alpha=0.8
+        )
+        ax.autoscale_view()
+
+    annotator = PointAnnotator(ax, meters_per_pixel=meters_per_pixel)
+    # Set the color index to continue from where we left off
+    annotator.current_color_index = len(existing_segments) % len(EXISTING_COLORS)
 
-        new_feature = annotator.annotate()
+    new_feature = annotator.annotate()
 
-        # Combine existing and new segments
-        all_segments = existing_segments + new_feature["geometry"]["coordinates"]
-        return geojson.Feature(None, geojson.MultiLineString(all_segments))
+    # Combine existing and new segments
+    all_segments = existing_segments + new_feature["geometry"]["coordinates"]
+    return multilinestring_feature(all_segments)
 
 
 if __name__ == "__main__":
@@ -230,10 +346,11 @@ if __name__ == "__main__":
         print("Usage: <map_image.tif>")
         sys.exit(1)
     input_file = sys.argv[1]
-    output_file = re.sub(r"\.tif+$", ".geojson", input_file)
+    select_backend()
+    output_file = _TIF_RE.sub(".geojson", input_file)
 
     feature = annotate_image(input_file, geojson_path=output_file)
-    feature_json = json.dumps(feature, sort_keys=True)
-    print(f"Saving {output_file}: {feature_json}")
-    with open(output_file, "w") as f:
+    feature_json = orjson.dumps(feature, option=orjson.OPT_SERIALIZE_NUMPY)
+    print(f"Saving {output_file}: {feature_json.decode()}")
+    with open(output_file, "wb") as f:
         f.write(feature_json)
@@ -1,13 +1,199 @@
-import rasterio.plot
-from collections import OrderedDict
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+import rasterio
+from rasterio.enums import MaskFlags, Resampling
+from rasterio.windows import Window
 
-def rasterio_as_image(src):
-    # Get RGB image
-    source_colorinterp = OrderedDict(zip(src.colorinterp, src.indexes))
+# GDAL settings for reading large local map rasters: a bigger block cache so
+# windowed reads don't re-decode blocks, and no sibling-file directory scan on
+# open. GTIFF_VIRTUAL_MEM_IO memory-maps uncompressed GeoTIFFs (Linux only);
+# it's ignored for compressed files and can misbehave on network filesystems,
+# so it is only enabled when the file fits in RAM.
+GDAL_ENV = dict(
+    GDAL_CACHEMAX=512,
+    GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR",
+    GDAL_TIFF_INTERNAL_MASK="YES",
+    VSI_CACHE="TRUE",
+    VSI_CACHE_SIZE="268435456",
+    GTIFF_VIRTUAL_MEM_IO="IF_ENOUGH_RAM",
+    # Lets a single decimated read of a file without overviews, as used by the
+    # annotator, decompress its blocks on all cores
+    GDAL_NUM_THREADS="ALL_CPUS",
+)
+
+
+def rgb_band_indexes(src):
+    ci = src.colorinterp
     colorinterp = rasterio.enums.ColorInterp
-    rgb_indexes = [
-        source_colorinterp[ci]
-        for ci in (colorinterp.red, colorinterp.green, colorinterp.blue)
-    ]
-    return rasterio.plot.reshape_as_image(src.read(rgb_indexes, masked=True))
+    rgb = (colorinterp.red, colorinterp.green, colorinterp.blue)
+    if not all(c in ci for c in rgb):
+        raise ValueError("raster has no red/green/blue bands")
+    # Bands are numbered 1..n in colorinterp order, so look up by position
+    return [ci.index(c) + 1 for c in rgb]
+
+
+def stretch_params(src, rgb_indexes):
+    """Return per-band (lo, scale) for a 2-98% contrast stretch onto 0..255.
+
+    Bands are sampled from their coarsest overview, or a 16x decimated read if
+    they have none, rather than at full resolution.
+    """
+    overviews = src.overviews(rgb_indexes[0])
+    factor = overviews[-1] if overviews else 16
+    small = src.read(
+        rgb_indexes,
+        out_shape=(
+            len(rgb_indexes),
+            max(1, src.height // factor),
+            max(1, src.width // factor),
+        ),
+        resampling=Resampling.nearest,
+        masked=True,
+    )
+    lo, hi = np.array([_band_range(band) for band in small], dtype=np.float32).T
+    scale = 255.0 / np.maximum(hi - lo, np.finfo(np.float32).eps)
+    return lo, scale
+
+
+def _band_range(band):
+    # 2nd and 98th percentiles of the valid pixels, ignoring unflagged NaNs
+    values = band.compressed()
+    floating = np.issubdtype(values.dtype, np.floating)
+    if values.size == 0 or (floating and np.isnan(values).all()):
+        # Nothing valid was sampled; fall back to the full dtype range
+        if np.issubdtype(band.dtype, np.integer):
+            info = np.iinfo(band.dtype)
+            return info.min, info.max
+        return 0.0, 1.0
+    if floating:
+        return np.nanpercentile(values, [2, 98])
+    return np.percentile(values, [2, 98])
+
+
+def _stretch_into(data, lo, scale, out):
+    # data is (bands, rows, cols); out is an (rows, cols, bands) uint8 view
+    stretched = np.clip((data.transpose((1, 2, 0)) - lo) * scale, 0, 255)
+    # Unflagged NaNs in float bands would otherwise cast to arbitrary values
+    out[...] = np.nan_to_num(stretched, copy=False).astype(np.uint8)
+
+
+def _fill_alpha(src, out, window=None, out_shape=None):
+    # out is an (rows, cols) uint8 view; nodata and masked pixels become transparent
+    if all(MaskFlags.all_valid in flags for flags in src.mask_flag_enums):
+        out[...] = 255
+    else:
+        out[...] = src.dataset_mask(window=window, out_shape=out_shape)
+
+
+def rasterio_as_image(path, out_shape=None, window=None):
+    """Read the RGB bands of the raster at path as a uint8 (rows, cols, 4) image.
+
+    The alpha channel comes from the dataset mask, so nodata shows as transparent.
+    If window is given only that part of the raster is read, at its native size
+    unless out_shape is also given.
+
+    Results are cached by path and modification time, so the returned array is
+    read-only and shared between callers.
+    """
+    path = os.path.realpath(path)
+    if window is not None:
+        # Windows aren't hashable, so the cache is keyed on their offsets and size
+        window = window.flatten()
+        if out_shape is None:
+            out_shape = (window[3], window[2])
+    if out_shape is not None:
+        out_shape = tuple(out_shape)
+    return _read_rgb(path, os.path.getmtime(path), out_shape, window)
+
+
+@functools.lru_cache(maxsize=4)
+def _read_rgb(path, _mtime, out_shape, window):
+    if window is not None:
+        window = Window(*window)
+    with rasterio.Env(**GDAL_ENV), rasterio.open(path, sharing=False) as src:
+        out = _read_rgb_from(src, out_shape, window)
+    out.flags.writeable = False
+    return out
+
+
+def _read_rgb_from(src, out_shape, window=None):
+    rgb_indexes = rgb_band_indexes(src)
+    # 8-bit sources are display-ready, so GDAL reads them straight into the
+    # RGB channels of the (rows, cols, 4) output through a band-first view,
+    # avoiding a copy
+    passthrough = np.dtype(src.dtypes[0]) == np.uint8
+    if not passthrough:
+        lo, scale = stretch_params(src, rgb_indexes)
+
+    if out_shape is not None:
+        # Decimated read; GDAL picks the nearest overview level if present
+        out = np.empty((*out_shape, 4), dtype=np.uint8)
+        if passthrough:
+            # rasterio rejects out with out_shape; out's shape sets the decimation
+            src.read(
+                rgb_indexes,
+                out=np.moveaxis(out[..., :3], -1, 0),
+                window=window,
+                resampling=Resampling.average,
+            )
+        else:
+            data = src.read(
+                rgb_indexes,
+                out_shape=(len(rgb_indexes), *out_shape),
+                window=window,
+                resampling=Resampling.average,
+            )
+            _stretch_into(data, lo, scale, out[..., :3])
+        _fill_alpha(src, out[..., 3], window=window, out_shape=out_shape)
+        return out
+
+    # Full-resolution reads (the analysis notebook; the annotator always passes
+    # out_shape and relies on GDAL_NUM_THREADS instead) decode blocks in
+    # parallel, each thread streaming through its own dataset handle and scratch
+    # buffers since handles aren't safe to share. GDAL releases the GIL while
+    # decompressing.
+    out = np.empty((src.height, src.width, 4), dtype=np.uint8)
+    local = threading.local()
+    handles = []
+
+    def read_block(window):
+        if not hasattr(local, "src"):
+            local.src = rasterio.open(src.name, sharing=False)
+            local.scratch = {}
+            handles.append(local.src)
+        rows = slice(window.row_off, window.row_off + window.height)
+        cols = slice(window.col_off, window.col_off + window.width)
+        _fill_alpha(local.src, out[rows, cols, 3], window=window)
+        if passthrough:
+            dest = np.moveaxis(out[rows, cols, :3], -1, 0)
+            local.src.read(rgb_indexes, window=window, out=dest)
+            return
+        shape = (len(rgb_indexes), window.height, window.width)
+        buf = local.scratch.get(shape)
+        if buf is None:
+            buf = local.scratch[shape] = np.empty(shape, dtype=src.dtypes[0])
+        local.src.read(rgb_indexes, window=window, out=buf)
+        _stretch_into(buf, lo, scale, out[rows, cols, :3])
+
+    try:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            windows = (window for _ji, window in src.block_windows(1))
+            # Consume the results so worker exceptions propagate
+            for _ in pool.map(read_block, windows):
+                pass
+    finally:
+        for handle in handles:
+            handle.close()
+    return out
+
+
+def display_shape(shape, fig):
+    """Return the (rows, cols) to read a raster at so it fits fig without upsampling."""
+    height, width = shape
+    fig_w, fig_h = fig.get_size_inches() * fig.dpi
+    factor = max(width / fig_w, height / fig_h, 1)
+    return max(1, int(height / factor)), max(1, int(width / factor))